@@ -0,0 +1,34 @@
+#!/usr/bin/env python3
+"""
+Rebuild the employee_balances ledger for the Urlaubsplaner
+Recomputes the yearly balances from vacation_entries and fixes any drift
+"""
+
+import argparse
+import asyncio
+
+from server import client, rebuild_employee_balances
+
+async def main(employee_id=None, dry_run=False):
+    """Rebuild (or with --dry-run only reconcile) the yearly balances"""
+    print("🔄 Reconciling employee balances..." if dry_run else "🔄 Rebuilding employee balances...")
+    
+    try:
+        result = await rebuild_employee_balances(employee_id, dry_run)
+        
+        for mismatch in result["mismatches"]:
+            print(f"   - {mismatch['employee_id']} {mismatch['year']}: stored {mismatch['stored']}, expected {mismatch['expected']}")
+        
+        if dry_run:
+            print(f"✅ Found {len(result['mismatches'])} balances out of sync")
+        else:
+            print(f"✅ Fixed {result['fixed']} balances")
+    finally:
+        client.close()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Rebuild the employee_balances ledger from vacation_entries")
+    parser.add_argument("--employee", dest="employee_id", help="Only rebuild balances of this employee")
+    parser.add_argument("--dry-run", action="store_true", help="Only report differences, do not write")
+    args = parser.parse_args()
+    asyncio.run(main(args.employee_id, args.dry_run))
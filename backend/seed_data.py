@@ -61,6 +61,8 @@ async def clear_existing_data():
     print("🗑️  Clearing existing data...")
     await db.employees.delete_many({})
     await db.vacation_entries.delete_many({})
+    await db.employee_balances.delete_many({})
+    await db.calendar_feeds.delete_many({})
     print("✅ Existing data cleared")
 
 async def create_employees():
@@ -190,6 +192,14 @@ async def create_sample_vacation_entries(employees):
     
     print(f"✅ Created {len(vacation_entries)} vacation entries")
 
+async def create_employee_balances():
+    """Build the yearly balances for the sample vacation entries"""
+    from server import rebuild_employee_balances
+    
+    print("📒 Building employee balances...")
+    result = await rebuild_employee_balances()
+    print(f"✅ Created {result['fixed']} employee balances")
+
 async def main():
     """Main seeder function"""
     print("🌱 Starting Urlaubsplaner data seeding...")
@@ -204,6 +214,9 @@ async def main():
         # Create vacation entries
         await create_sample_vacation_entries(employees)
         
+        # Build yearly balances
+        await create_employee_balances()
+        
         print("\n🎉 Data seeding completed successfully!")
         print(f"📊 Summary:")
         print(f"   - {len(employees)} employees created")
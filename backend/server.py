@@ -1,14 +1,22 @@
-from fastapi import FastAPI, APIRouter, HTTPException
+from fastapi import FastAPI, APIRouter, HTTPException, Request
+from fastapi.responses import Response, StreamingResponse
 from dotenv import load_dotenv
 from starlette.middleware.cors import CORSMiddleware
 from motor.motor_asyncio import AsyncIOMotorClient
+from pymongo import DeleteOne, ReplaceOne, ReturnDocument
 import os
+import csv
+import io
 import logging
+import time
+import zipfile
+from email.utils import format_datetime, parsedate_to_datetime
+from xml.sax.saxutils import escape as xml_escape
 from pathlib import Path
 from pydantic import BaseModel, Field
-from typing import List, Optional
+from typing import AsyncIterator, Dict, List, Optional
 import uuid
-from datetime import datetime, date
+from datetime import datetime, date, timedelta, timezone
 from enum import Enum
 
 ROOT_DIR = Path(__file__).parent
@@ -47,6 +55,7 @@ class Employee(BaseModel):
     email: Optional[str] = ""
     role: UserRole = UserRole.EMPLOYEE
     vacation_days_total: int = 25
+    team: Optional[str] = ""  # Department/team for team-specific vacation limits
     skills: List[Skill] = Field(default_factory=list)
     created_date: datetime = Field(default_factory=datetime.utcnow)
 
@@ -54,6 +63,7 @@ class EmployeeCreate(BaseModel):
     name: str
     email: Optional[str] = ""
     role: UserRole = UserRole.EMPLOYEE
+    team: Optional[str] = ""
     skills: List[Skill] = Field(default_factory=list)
 
 class VacationEntry(BaseModel):
@@ -74,9 +84,19 @@ class VacationEntryCreate(BaseModel):
     vacation_type: VacationType
     notes: Optional[str] = ""
 
+class TeamLimit(BaseModel):
+    max_concurrent_percentage: Optional[int] = Field(default=None, ge=1, le=100)  # Falls back to company percentage
+    max_concurrent_fixed: Optional[int] = Field(default=None, ge=1)  # Fixed number instead of percentage
+
 class CompanySettings(BaseModel):
-    max_concurrent_percentage: int = 30  # 30% of total employees
-    max_concurrent_fixed: Optional[int] = None  # Fixed number instead of percentage
+    max_concurrent_percentage: int = Field(default=30, ge=1, le=100)  # 30% of total employees
+    max_concurrent_fixed: Optional[int] = Field(default=None, ge=1)  # Fixed number instead of percentage
+    team_limits: Dict[str, TeamLimit] = Field(default_factory=dict)  # Limits per department/team
+
+# Company settings are stored as a single document and served from an in-memory snapshot
+SETTINGS_DOCUMENT_ID = "company"
+SETTINGS_VERSION_CHECK_SECONDS = 5  # How long other workers may serve an outdated snapshot
+settings_snapshot = {"version": 0, "settings": CompanySettings(), "loaded": False, "checked_at": 0.0}
 
 # Helper Functions
 def calculate_business_days(start_date: date, end_date: date) -> int:
@@ -101,9 +121,71 @@ async def get_employee_by_id(employee_id: str) -> Optional[Employee]:
         return Employee(**employee_data)
     return None
 
-async def check_concurrent_vacations(start_date: date, end_date: date, exclude_entry_id: Optional[str] = None) -> dict:
-    """Check if adding this vacation would exceed the concurrent limit"""
+def calculate_max_allowed(percentage: int, fixed: Optional[int], headcount: int) -> int:
+    """Calculate how many people may be on vacation at the same time"""
+    if fixed:
+        return fixed
+    if headcount > 0:
+        return max(1, int((percentage / 100) * headcount))
+    return 1  # Fallback for empty company/team
+
+def parse_stored_date(value) -> date:
+    """Parse a date stored in MongoDB (ISO string or date object)"""
+    if isinstance(value, str):
+        return datetime.strptime(value, "%Y-%m-%d").date()
+    if isinstance(value, datetime):
+        return value.date()
+    return value
+
+def store_settings_snapshot(settings_data: dict) -> None:
+    """Replace the in-memory settings snapshot unless it is already newer"""
+    version = settings_data.get("version", 0)
+    settings_snapshot["checked_at"] = time.monotonic()
+    if settings_snapshot["loaded"] and version < settings_snapshot["version"]:
+        return
+    settings_snapshot["settings"] = CompanySettings(**settings_data)
+    settings_snapshot["version"] = version
+    settings_snapshot["loaded"] = True
+
+async def refresh_settings_snapshot() -> None:
+    """Reload company settings from MongoDB into the in-memory snapshot"""
+    settings_data = await db.settings.find_one({"id": SETTINGS_DOCUMENT_ID})
+    store_settings_snapshot(settings_data or {})
+
+async def get_settings() -> CompanySettings:
+    """Get the current company settings snapshot"""
+    if not settings_snapshot["loaded"]:
+        await refresh_settings_snapshot()
+    elif time.monotonic() - settings_snapshot["checked_at"] >= SETTINGS_VERSION_CHECK_SECONDS:
+        # Changes written by other workers are picked up by a periodic version check,
+        # PUT /settings updates the snapshot of its own worker immediately
+        settings_snapshot["checked_at"] = time.monotonic()
+        stored = await db.settings.find_one({"id": SETTINGS_DOCUMENT_ID}, {"version": 1})
+        if stored and stored.get("version", 0) > settings_snapshot["version"]:
+            await refresh_settings_snapshot()
+    return settings_snapshot["settings"]
+
+def find_peak_day(start_date: date, daily_counts: List[int]) -> tuple:
+    """Find the business day with the highest count (including the new vacation)"""
     from datetime import timedelta
+
+    max_concurrent_day = None
+    max_concurrent_count = 0
+    for offset, daily_count in enumerate(daily_counts):
+        current_date = start_date + timedelta(days=offset)
+        if current_date.weekday() < 5 and daily_count + 1 > max_concurrent_count:
+            max_concurrent_count = daily_count + 1
+            max_concurrent_day = current_date
+    return max_concurrent_count, max_concurrent_day
+
+async def check_concurrent_vacations(
+    start_date: date,
+    end_date: date,
+    exclude_entry_id: Optional[str] = None,
+    team: Optional[str] = None
+) -> dict:
+    """Check if adding this vacation would exceed the company or team concurrent limit"""
+    settings = await get_settings()
     
     # Convert dates to ISO format for MongoDB query
     start_date_str = start_date.isoformat()
@@ -119,64 +201,233 @@ async def check_concurrent_vacations(start_date: date, end_date: date, exclude_e
     if exclude_entry_id:
         overlap_query["id"] = {"$ne": exclude_entry_id}
     
-    overlapping_vacations = await db.vacation_entries.find(overlap_query).to_list(1000)
-    
     # Get total number of employees
     total_employees = await db.employees.count_documents({})
     
-    # Check each day in the range
-    current_date = start_date
-    max_concurrent_day = None
-    max_concurrent_count = 0
+    # Team limit only applies if one is configured for the employee's team
+    team_limit = settings.team_limits.get(team) if team else None
+    team_member_ids = set()
+    if team_limit:
+        team_members = await db.employees.find({"team": team}, {"id": 1}).to_list(None)
+        team_member_ids = {member["id"] for member in team_members}
     
-    while current_date <= end_date:
-        if current_date.weekday() < 5:  # Only check business days
-            daily_count = 0
-            for vacation in overlapping_vacations:
-                # Handle both string and date objects for compatibility
-                if isinstance(vacation["start_date"], str):
-                    vacation_start = datetime.strptime(vacation["start_date"], "%Y-%m-%d").date()
-                else:
-                    vacation_start = vacation["start_date"]
-                    
-                if isinstance(vacation["end_date"], str):
-                    vacation_end = datetime.strptime(vacation["end_date"], "%Y-%m-%d").date()
-                else:
-                    vacation_end = vacation["end_date"]
-                    
-                if vacation_start <= current_date <= vacation_end:
-                    daily_count += 1
-            
-            # Add 1 for the new vacation we're checking
-            daily_count += 1
-            
-            if daily_count > max_concurrent_count:
-                max_concurrent_count = daily_count
-                max_concurrent_day = current_date
+    # Count occupancy per day for all applicable limits in a single pass,
+    # using difference arrays so each entry is touched only once
+    num_days = (end_date - start_date).days + 1
+    company_diff = [0] * (num_days + 1)
+    team_diff = [0] * (num_days + 1)
+    
+    projection = {"employee_id": 1, "start_date": 1, "end_date": 1}
+    async for vacation in db.vacation_entries.find(overlap_query, projection):
+        first_offset = max((parse_stored_date(vacation["start_date"]) - start_date).days, 0)
+        last_offset = min((parse_stored_date(vacation["end_date"]) - start_date).days, num_days - 1)
+        if first_offset > last_offset:
+            continue
         
-        current_date += timedelta(days=1)
+        company_diff[first_offset] += 1
+        company_diff[last_offset + 1] -= 1
+        if vacation["employee_id"] in team_member_ids:
+            team_diff[first_offset] += 1
+            team_diff[last_offset + 1] -= 1
     
-    settings = CompanySettings()
+    company_counts = []
+    team_counts = []
+    company_running = team_running = 0
+    for offset in range(num_days):
+        company_running += company_diff[offset]
+        team_running += team_diff[offset]
+        company_counts.append(company_running)
+        team_counts.append(team_running)
     
-    # Calculate max allowed based on settings
-    if settings.max_concurrent_fixed:
-        max_allowed = settings.max_concurrent_fixed
-    elif total_employees > 0:
-        max_allowed = max(1, int((settings.max_concurrent_percentage / 100) * total_employees))
-    else:
-        max_allowed = 1  # Fallback for empty company
+    max_concurrent_count, max_concurrent_day = find_peak_day(start_date, company_counts)
+    max_allowed = calculate_max_allowed(
+        settings.max_concurrent_percentage, settings.max_concurrent_fixed, total_employees
+    )
     
     percentage = round((max_concurrent_count / max(total_employees, 1)) * 100, 1) if total_employees > 0 else 0
     
+    team_check = None
+    if team_limit:
+        team_total = len(team_member_ids)
+        team_count, team_day = find_peak_day(start_date, team_counts)
+        team_max_allowed = calculate_max_allowed(
+            team_limit.max_concurrent_percentage or settings.max_concurrent_percentage,
+            team_limit.max_concurrent_fixed,
+            team_total
+        )
+        team_check = {
+            "team": team,
+            "is_valid": team_count <= team_max_allowed,
+            "max_concurrent_count": team_count,
+            "max_allowed": team_max_allowed,
+            "max_concurrent_day": team_day,
+            "percentage": round((team_count / team_total) * 100, 1) if team_total > 0 else 0,
+            "total_employees": team_total
+        }
+    
     return {
-        "is_valid": max_concurrent_count <= max_allowed,
+        "is_valid": max_concurrent_count <= max_allowed and (team_check is None or team_check["is_valid"]),
         "max_concurrent_count": max_concurrent_count,
         "max_allowed": max_allowed,
         "max_concurrent_day": max_concurrent_day,
         "percentage": percentage,
-        "total_employees": total_employees
+        "total_employees": total_employees,
+        "team_check": team_check
     }
 
+def team_limit_error(team_check: dict) -> str:
+    """Build the error message for an exceeded team limit"""
+    return (
+        f"Too many concurrent vacations in team {team_check['team']}. "
+        f"Maximum {team_check['max_allowed']} people ({team_check['percentage']}%) of this team can be on vacation simultaneously. "
+        f"Peak day: {team_check['max_concurrent_day']} with {team_check['max_concurrent_count']} people."
+    )
+
+async def touch_calendar_feed(employee_id: str) -> dict:
+    """Bump the version of an employee's calendar feed after a change"""
+    # Last-Modified has second precision, so store it without microseconds and
+    # always move it forward by at least a second; otherwise two writes in the
+    # same second would make If-Modified-Since answer 304 for a changed feed
+    now = datetime.utcnow().replace(microsecond=0)
+    return await db.calendar_feeds.find_one_and_update(
+        {"employee_id": employee_id},
+        [{
+            "$set": {
+                "employee_id": employee_id,
+                "version": {"$add": [{"$ifNull": ["$version", 0]}, 1]},
+                "updated_date": {
+                    "$max": [now, {"$add": [{"$ifNull": ["$updated_date", datetime(1970, 1, 1)]}, 1000]}]
+                }
+            }
+        }],
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+
+# Materialized yearly balances, one document per (employee_id, year)
+BALANCE_FIELDS = {
+    VacationType.URLAUB: "vacation_days_used",
+    VacationType.KRANKHEIT: "sick_days",
+    VacationType.SONDERURLAUB: "special_leave_days"
+}
+
+def split_business_days_by_year(start_date: date, end_date: date) -> Dict[int, int]:
+    """Split the business days of a date range by calendar year"""
+    days_by_year = {}
+    for year in range(start_date.year, end_date.year + 1):
+        days = calculate_business_days(max(start_date, date(year, 1, 1)), min(end_date, date(year, 12, 31)))
+        if days:
+            days_by_year[year] = days
+    return days_by_year
+
+def same_balance_booking(first: dict, second: dict) -> bool:
+    """Check whether two stored entries book the same days on the balances"""
+    return all(first[field] == second[field] for field in ("employee_id", "start_date", "end_date", "vacation_type"))
+
+def balance_increments(vacation_type: Optional[VacationType] = None, days: int = 0) -> dict:
+    """Build a $inc document touching every balance field so upserts create all of them"""
+    increments = {field: 0 for field in BALANCE_FIELDS.values()}
+    if vacation_type:
+        increments[BALANCE_FIELDS[VacationType(vacation_type)]] = days
+    return increments
+
+async def apply_balance_change(employee_id: str, start_date: date, end_date: date, vacation_type: VacationType, sign: int = 1) -> None:
+    """Add (sign=1) or remove (sign=-1) an entry's days from the yearly balances"""
+    for year, days in split_business_days_by_year(start_date, end_date).items():
+        await db.employee_balances.update_one(
+            {"employee_id": employee_id, "year": year},
+            {"$inc": balance_increments(vacation_type, sign * days)},
+            upsert=True
+        )
+
+async def apply_entry_balance_change(entry_data: dict, sign: int = 1) -> None:
+    """Add or remove a stored vacation entry's days from the yearly balances"""
+    await apply_balance_change(
+        entry_data["employee_id"],
+        parse_stored_date(entry_data["start_date"]),
+        parse_stored_date(entry_data["end_date"]),
+        entry_data["vacation_type"],
+        sign
+    )
+
+async def reserve_vacation_days(employee: Employee, start_date: date, end_date: date) -> None:
+    """Atomically book vacation days against the yearly entitlement"""
+    reserved = []
+    for year, days in split_business_days_by_year(start_date, end_date).items():
+        key = {"employee_id": employee.id, "year": year}
+        await db.employee_balances.update_one(key, {"$inc": balance_increments()}, upsert=True)
+        
+        # Only increments if the days still fit into the entitlement
+        result = await db.employee_balances.update_one(
+            {**key, "vacation_days_used": {"$lte": employee.vacation_days_total - days}},
+            {"$inc": balance_increments(VacationType.URLAUB, days)}
+        )
+        if result.modified_count == 0:
+            for reserved_key, reserved_days in reserved:
+                await db.employee_balances.update_one(
+                    reserved_key, {"$inc": balance_increments(VacationType.URLAUB, -reserved_days)}
+                )
+            balance = await db.employee_balances.find_one(key)
+            remaining = employee.vacation_days_total - balance["vacation_days_used"]
+            raise HTTPException(
+                status_code=400,
+                detail=f"Not enough vacation days left in {year}. {remaining} of {employee.vacation_days_total} days remaining, {days} requested."
+            )
+        reserved.append((key, days))
+
+async def book_entry_balance(employee: Employee, vacation_data: VacationEntryCreate) -> None:
+    """Add a new or updated entry to the balances, enforcing the vacation entitlement"""
+    if vacation_data.vacation_type == VacationType.URLAUB:
+        await reserve_vacation_days(employee, vacation_data.start_date, vacation_data.end_date)
+    else:
+        await apply_balance_change(employee.id, vacation_data.start_date, vacation_data.end_date, vacation_data.vacation_type)
+
+async def rebuild_employee_balances(employee_id: Optional[str] = None, dry_run: bool = False) -> dict:
+    """Recompute the balances from vacation_entries and fix any drift.
+    
+    Writes made while the rebuild is running can be lost, so only run it while
+    the API is idle (at startup or via rebuild_balances.py). With dry_run the
+    differences are only reported.
+    """
+    entry_query = {"employee_id": employee_id} if employee_id else {}
+    expected = {}
+    projection = {"employee_id": 1, "start_date": 1, "end_date": 1, "vacation_type": 1}
+    async for entry in db.vacation_entries.find(entry_query, projection):
+        split = split_business_days_by_year(parse_stored_date(entry["start_date"]), parse_stored_date(entry["end_date"]))
+        for year, days in split.items():
+            balance = expected.setdefault((entry["employee_id"], year), balance_increments())
+            balance[BALANCE_FIELDS[VacationType(entry["vacation_type"])]] += days
+    
+    operations = []
+    mismatches = []
+    async for stored in db.employee_balances.find(entry_query):
+        key = (stored["employee_id"], stored["year"])
+        balance = expected.pop(key, None)
+        if balance is None:
+            if any(stored.get(field, 0) for field in BALANCE_FIELDS.values()):
+                mismatches.append({"employee_id": key[0], "year": key[1], "stored": stored, "expected": None})
+            operations.append(DeleteOne({"_id": stored["_id"]}))
+        elif any(stored.get(field) != value for field, value in balance.items()):
+            mismatches.append({"employee_id": key[0], "year": key[1], "stored": stored, "expected": balance})
+            operations.append(ReplaceOne({"_id": stored["_id"]}, {"employee_id": key[0], "year": key[1], **balance}))
+    
+    for (balance_employee_id, year), balance in expected.items():
+        mismatches.append({"employee_id": balance_employee_id, "year": year, "stored": None, "expected": balance})
+        operations.append(ReplaceOne(
+            {"employee_id": balance_employee_id, "year": year},
+            {"employee_id": balance_employee_id, "year": year, **balance},
+            upsert=True
+        ))
+    
+    for mismatch in mismatches:
+        if mismatch["stored"]:
+            mismatch["stored"] = {field: mismatch["stored"].get(field, 0) for field in BALANCE_FIELDS.values()}
+    
+    if operations and not dry_run:
+        await db.employee_balances.bulk_write(operations, ordered=False)
+    
+    return {"mismatches": mismatches, "fixed": 0 if dry_run else len(mismatches)}
+
 # API Endpoints
 
 # Employee Management
@@ -208,13 +459,19 @@ async def update_employee(employee_id: str, employee_data: EmployeeCreate):
     if not existing_employee:
         raise HTTPException(status_code=404, detail="Employee not found")
     
+    employee_dict = employee_data.dict()
+    # Keep the team if the client did not send one (e.g. older frontend payloads)
+    if "team" not in employee_data.model_fields_set:
+        employee_dict["team"] = existing_employee.team
+    
     updated_employee = Employee(
         id=employee_id,
-        **employee_data.dict(),
+        **employee_dict,
         created_date=existing_employee.created_date
     )
     
     await db.employees.replace_one({"id": employee_id}, updated_employee.dict())
+    await touch_calendar_feed(employee_id)
     return updated_employee
 
 @api_router.delete("/employees/{employee_id}")
@@ -226,9 +483,11 @@ async def delete_employee(employee_id: str):
     
     # Delete all vacation entries for this employee
     await db.vacation_entries.delete_many({"employee_id": employee_id})
+    await db.employee_balances.delete_many({"employee_id": employee_id})
     
     # Delete the employee
     await db.employees.delete_one({"id": employee_id})
+    await db.calendar_feeds.delete_one({"employee_id": employee_id})
     
     return {"message": "Employee and all vacation entries deleted successfully"}
 
@@ -250,7 +509,14 @@ async def create_vacation_entry(vacation_data: VacationEntryCreate):
     
     # Check concurrent vacation limits (only for actual vacations, not sick days)
     if vacation_data.vacation_type == VacationType.URLAUB:
-        concurrent_check = await check_concurrent_vacations(vacation_data.start_date, vacation_data.end_date)
+        concurrent_check = await check_concurrent_vacations(
+            vacation_data.start_date,
+            vacation_data.end_date,
+            team=employee.team
+        )
+        team_check = concurrent_check["team_check"]
+        if team_check and not team_check["is_valid"]:
+            raise HTTPException(status_code=400, detail=team_limit_error(team_check))
         if not concurrent_check["is_valid"]:
             raise HTTPException(
                 status_code=400, 
@@ -273,7 +539,16 @@ async def create_vacation_entry(vacation_data: VacationEntryCreate):
     entry_dict['start_date'] = vacation_dict['start_date']  # Keep as string
     entry_dict['end_date'] = vacation_dict['end_date']      # Keep as string
     
-    await db.vacation_entries.insert_one(entry_dict)
+    # Book the days on the yearly balance first, this also enforces the entitlement
+    await book_entry_balance(employee, vacation_data)
+    try:
+        await db.vacation_entries.insert_one(entry_dict)
+    except Exception:
+        await apply_balance_change(
+            employee.id, vacation_data.start_date, vacation_data.end_date, vacation_data.vacation_type, sign=-1
+        )
+        raise
+    await touch_calendar_feed(vacation_entry.employee_id)
     return vacation_entry
 
 @api_router.get("/vacation-entries", response_model=List[VacationEntry])
@@ -335,8 +610,12 @@ async def update_vacation_entry(entry_id: str, vacation_data: VacationEntryCreat
         concurrent_check = await check_concurrent_vacations(
             vacation_data.start_date, 
             vacation_data.end_date, 
-            exclude_entry_id=entry_id
+            exclude_entry_id=entry_id,
+            team=employee.team
         )
+        team_check = concurrent_check["team_check"]
+        if team_check and not team_check["is_valid"]:
+            raise HTTPException(status_code=400, detail=team_limit_error(team_check))
         if not concurrent_check["is_valid"]:
             raise HTTPException(
                 status_code=400, 
@@ -361,43 +640,68 @@ async def update_vacation_entry(entry_id: str, vacation_data: VacationEntryCreat
     entry_dict['start_date'] = vacation_dict['start_date']  # Keep as string
     entry_dict['end_date'] = vacation_dict['end_date']      # Keep as string
     
-    await db.vacation_entries.replace_one({"id": entry_id}, entry_dict)
+    # Move the days on the yearly balances, restoring the old booking if the new one does not fit
+    await apply_entry_balance_change(existing_entry_data, sign=-1)
+    try:
+        await book_entry_balance(employee, vacation_data)
+    except HTTPException:
+        await apply_entry_balance_change(existing_entry_data)
+        raise
+    
+    replaced_entry_data = None
+    try:
+        replaced_entry_data = await db.vacation_entries.find_one_and_replace(
+            {"id": entry_id}, entry_dict, return_document=ReturnDocument.BEFORE
+        )
+    finally:
+        if replaced_entry_data is None:
+            # Nothing was replaced (write failed or entry deleted meanwhile), undo the booking
+            await apply_balance_change(
+                employee.id, vacation_data.start_date, vacation_data.end_date, vacation_data.vacation_type, sign=-1
+            )
+            await apply_entry_balance_change(existing_entry_data)
+    
+    if replaced_entry_data is None:
+        raise HTTPException(status_code=404, detail="Vacation entry not found")
+    
+    # A concurrent update may have replaced the entry after we read it; the
+    # document actually replaced is the one whose days have to be removed
+    if not same_balance_booking(replaced_entry_data, existing_entry_data):
+        await apply_entry_balance_change(existing_entry_data)
+        await apply_entry_balance_change(replaced_entry_data, sign=-1)
+    
+    await touch_calendar_feed(updated_entry.employee_id)
+    if replaced_entry_data["employee_id"] != updated_entry.employee_id:
+        await touch_calendar_feed(replaced_entry_data["employee_id"])
     return updated_entry
 
 @api_router.delete("/vacation-entries/{entry_id}")
 async def delete_vacation_entry(entry_id: str):
     """Delete vacation entry"""
-    entry_data = await db.vacation_entries.find_one({"id": entry_id})
+    # Only the request that actually deleted the entry removes its days
+    entry_data = await db.vacation_entries.find_one_and_delete({"id": entry_id})
     if not entry_data:
         raise HTTPException(status_code=404, detail="Vacation entry not found")
     
-    await db.vacation_entries.delete_one({"id": entry_id})
+    await apply_entry_balance_change(entry_data, sign=-1)
+    await touch_calendar_feed(entry_data["employee_id"])
     return {"message": "Vacation entry deleted successfully"}
 
 # Analytics & Reporting
 @api_router.get("/analytics/employee-summary/{employee_id}")
-async def get_employee_vacation_summary(employee_id: str, year: int = 2025):
+async def get_employee_vacation_summary(employee_id: str, year: int = 2025, include_entries: bool = False):
     """Get vacation summary for a specific employee and year"""
     employee = await get_employee_by_id(employee_id)
     if not employee:
         raise HTTPException(status_code=404, detail="Employee not found")
     
-    # Get vacation entries for the year
-    start_of_year = date(year, 1, 1)
-    end_of_year = date(year, 12, 31)
-    
-    vacation_entries = await db.vacation_entries.find({
-        "employee_id": employee_id,
-        "start_date": {"$gte": start_of_year},
-        "end_date": {"$lte": end_of_year}
-    }).to_list(1000)
-    
-    # Calculate totals by type
-    urlaub_days = sum(entry["days_count"] for entry in vacation_entries if entry["vacation_type"] == VacationType.URLAUB)
-    krankheit_days = sum(entry["days_count"] for entry in vacation_entries if entry["vacation_type"] == VacationType.KRANKHEIT)
-    sonderurlaub_days = sum(entry["days_count"] for entry in vacation_entries if entry["vacation_type"] == VacationType.SONDERURLAUB)
+    # Totals come from the materialized yearly balance
+    balance = await db.employee_balances.find_one({"employee_id": employee_id, "year": year}) or {}
+    urlaub_days = balance.get("vacation_days_used", 0)
+    krankheit_days = balance.get("sick_days", 0)
+    sonderurlaub_days = balance.get("special_leave_days", 0)
     
-    return {
+    summary = {
         "employee": employee,
         "year": year,
         "vacation_days_total": employee.vacation_days_total,
@@ -405,31 +709,43 @@ async def get_employee_vacation_summary(employee_id: str, year: int = 2025):
         "vacation_days_remaining": employee.vacation_days_total - urlaub_days,
         "sick_days": krankheit_days,
         "special_leave_days": sonderurlaub_days,
-        "total_days_off": urlaub_days + krankheit_days + sonderurlaub_days,
-        "vacation_entries": [VacationEntry(**entry) for entry in vacation_entries]
+        "total_days_off": urlaub_days + krankheit_days + sonderurlaub_days
     }
+    
+    if include_entries:
+        vacation_entries = await db.vacation_entries.find({
+            "employee_id": employee_id,
+            "start_date": {"$lte": date(year, 12, 31).isoformat()},
+            "end_date": {"$gte": date(year, 1, 1).isoformat()}
+        }).sort("start_date", 1).to_list(1000)
+        summary["vacation_entries"] = [VacationEntry(**entry) for entry in vacation_entries]
+    
+    return summary
+
+@api_router.get("/analytics/balances/reconcile")
+async def reconcile_balances(employee_id: Optional[str] = None):
+    """Report yearly balances that differ from the vacation entries (use rebuild_balances.py to fix them)"""
+    return await rebuild_employee_balances(employee_id, dry_run=True)
 
 @api_router.get("/analytics/employee-sick-days/{employee_id}")
 async def get_employee_sick_days(employee_id: str, year: int = 2025):
     """Get sick days for a specific employee and year"""
-    # Get vacation entries for the year that are sick days
-    start_of_year = date(year, 1, 1)
-    end_of_year = date(year, 12, 31)
+    # Sick days come from the yearly balance, so entries crossing the year are split
+    balance = await db.employee_balances.find_one({"employee_id": employee_id, "year": year}) or {}
     
-    sick_entries = await db.vacation_entries.find({
+    # Count sick entries that touch the year
+    sick_entries_count = await db.vacation_entries.count_documents({
         "employee_id": employee_id,
         "vacation_type": VacationType.KRANKHEIT,
-        "start_date": {"$gte": start_of_year.isoformat()},
-        "end_date": {"$lte": end_of_year.isoformat()}
-    }).to_list(1000)
-    
-    total_sick_days = sum(entry["days_count"] for entry in sick_entries)
+        "start_date": {"$lte": date(year, 12, 31).isoformat()},
+        "end_date": {"$gte": date(year, 1, 1).isoformat()}
+    })
     
     return {
         "employee_id": employee_id,
         "year": year,
-        "sick_days": total_sick_days,
-        "sick_entries_count": len(sick_entries)
+        "sick_days": balance.get("sick_days", 0),
+        "sick_entries_count": sick_entries_count
     }
 
 @api_router.get("/analytics/team-overview")
@@ -455,18 +771,373 @@ async def get_team_overview(start_date: date, end_date: date):
         "vacation_entries": [VacationEntry(**entry) for entry in vacation_entries]
     }
 
-@api_router.get("/settings")
-async def get_company_settings():
-    """Get company settings with current employee count"""
+async def build_settings_response(settings: CompanySettings, version: int) -> dict:
+    """Build the settings response with current employee and team counts"""
     total_employees = await db.employees.count_documents({})
-    settings = CompanySettings()
+    
+    # Count employees per team in one aggregation instead of one query per team
+    team_counts = {}
+    async for group in db.employees.aggregate([{"$group": {"_id": "$team", "count": {"$sum": 1}}}]):
+        team_counts[group["_id"]] = group["count"]
+    
+    team_limits = {}
+    for team, limit in settings.team_limits.items():
+        team_total = team_counts.get(team, 0)
+        team_limits[team] = {
+            "max_concurrent_percentage": limit.max_concurrent_percentage,
+            "max_concurrent_fixed": limit.max_concurrent_fixed,
+            "total_employees": team_total,
+            "max_concurrent_calculated": calculate_max_allowed(
+                limit.max_concurrent_percentage or settings.max_concurrent_percentage,
+                limit.max_concurrent_fixed,
+                team_total
+            )
+        }
     
     return {
+        "version": version,
         "max_concurrent_percentage": settings.max_concurrent_percentage,
         "max_concurrent_fixed": settings.max_concurrent_fixed,
         "total_employees": total_employees,
-        "max_concurrent_calculated": settings.max_concurrent_fixed or max(1, int((settings.max_concurrent_percentage / 100) * total_employees))
+        "max_concurrent_calculated": calculate_max_allowed(
+            settings.max_concurrent_percentage, settings.max_concurrent_fixed, total_employees
+        ),
+        "team_limits": team_limits
+    }
+
+@api_router.get("/settings")
+async def get_company_settings():
+    """Get company settings with current employee count"""
+    settings = await get_settings()
+    return await build_settings_response(settings, settings_snapshot["version"])
+
+@api_router.put("/settings")
+async def update_company_settings(settings_data: CompanySettings):
+    """Update company settings and refresh the in-memory snapshot"""
+    updated = await db.settings.find_one_and_update(
+        {"id": SETTINGS_DOCUMENT_ID},
+        {"$set": settings_data.dict(), "$inc": {"version": 1}},
+        upsert=True,
+        return_document=ReturnDocument.AFTER
+    )
+    store_settings_snapshot(updated)
+    return await build_settings_response(CompanySettings(**updated), updated["version"])
+
+# Calendar Export
+EXPORT_COLUMNS = ["id", "employee_id", "employee_name", "start_date", "end_date", "vacation_type", "days_count", "notes"]
+EXPORT_CHUNK_SIZE = 500  # Rows per chunk written to the response
+ICS_PRODID = "-//Urlaubsplaner//Urlaubsplaner API//DE"
+
+def build_export_query(
+    employee_id: Optional[str] = None,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    vacation_type: Optional[VacationType] = None
+) -> dict:
+    """Build the MongoDB query for exported vacation entries"""
+    query = {}
+    
+    if employee_id:
+        query["employee_id"] = employee_id
+    if start_date:
+        query["end_date"] = {"$gte": start_date.isoformat()}
+    if end_date:
+        query["start_date"] = {"$lte": end_date.isoformat()}
+    if vacation_type:
+        query["vacation_type"] = vacation_type
+    
+    return query
+
+def export_cursor(query: dict):
+    """Get a cursor over exported vacation entries, ordered by start date"""
+    projection = {column: 1 for column in EXPORT_COLUMNS + ["created_date"]}
+    projection["_id"] = 0
+    return db.vacation_entries.find(query, projection).sort("start_date", 1).batch_size(EXPORT_CHUNK_SIZE)
+
+def export_row(entry: dict) -> list:
+    """Convert a stored vacation entry into an export row"""
+    return [
+        entry.get("id", ""),
+        entry.get("employee_id", ""),
+        entry.get("employee_name", ""),
+        parse_stored_date(entry["start_date"]).isoformat(),
+        parse_stored_date(entry["end_date"]).isoformat(),
+        entry.get("vacation_type", ""),
+        entry.get("days_count", 0),
+        entry.get("notes") or ""
+    ]
+
+async def stream_csv(query: dict) -> AsyncIterator[str]:
+    """Stream vacation entries as CSV, one chunk per batch of rows"""
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(EXPORT_COLUMNS)
+    rows = 0
+    
+    async for entry in export_cursor(query):
+        writer.writerow(export_row(entry))
+        rows += 1
+        if rows % EXPORT_CHUNK_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    
+    yield buffer.getvalue()
+
+def ics_escape(value: str) -> str:
+    """Escape a text value for iCalendar (RFC 5545)"""
+    return (
+        value.replace("\\", "\\\\")
+        .replace(";", "\\;")
+        .replace(",", "\\,")
+        .replace("\r\n", "\\n")
+        .replace("\n", "\\n")
+    )
+
+def ics_line(line: str) -> str:
+    """Fold an iCalendar content line to 75 octets and terminate it with CRLF"""
+    encoded = line.encode("utf-8")
+    if len(encoded) <= 75:
+        return line + "\r\n"
+    
+    parts = []
+    limit = 75
+    while len(encoded) > limit:
+        # Never split inside a multi-byte UTF-8 sequence
+        cut = limit
+        while (encoded[cut] & 0xC0) == 0x80:
+            cut -= 1
+        parts.append(encoded[:cut].decode("utf-8"))
+        encoded = encoded[cut:]
+        limit = 74  # Continuation lines start with a space
+    parts.append(encoded.decode("utf-8"))
+    return "\r\n ".join(parts) + "\r\n"
+
+def ics_event(entry: dict, dtstamp: str) -> str:
+    """Render a vacation entry as an all-day VEVENT"""
+    start = parse_stored_date(entry["start_date"])
+    end = parse_stored_date(entry["end_date"]) + timedelta(days=1)  # DTEND is exclusive
+    summary = f"{entry.get('employee_name', '')} - {entry.get('vacation_type', '')}"
+    lines = [
+        "BEGIN:VEVENT",
+        f"UID:{entry['id']}@urlaubsplaner",
+        f"DTSTAMP:{dtstamp}",
+        f"DTSTART;VALUE=DATE:{start.strftime('%Y%m%d')}",
+        f"DTEND;VALUE=DATE:{end.strftime('%Y%m%d')}",
+        f"SUMMARY:{ics_escape(summary)}",
+        f"CATEGORIES:{entry.get('vacation_type', '')}",
+        "TRANSP:OPAQUE" if entry.get("vacation_type") == VacationType.URLAUB else "TRANSP:TRANSPARENT",
+    ]
+    if entry.get("notes"):
+        lines.append(f"DESCRIPTION:{ics_escape(entry['notes'])}")
+    lines.append("END:VEVENT")
+    return "".join(ics_line(line) for line in lines)
+
+async def stream_ics(query: dict, calendar_name: str) -> AsyncIterator[str]:
+    """Stream vacation entries as an iCalendar file, one event at a time"""
+    dtstamp = datetime.utcnow().strftime("%Y%m%dT%H%M%SZ")
+    yield "".join(ics_line(line) for line in [
+        "BEGIN:VCALENDAR",
+        "VERSION:2.0",
+        f"PRODID:{ICS_PRODID}",
+        "CALSCALE:GREGORIAN",
+        "METHOD:PUBLISH",
+        f"X-WR-CALNAME:{ics_escape(calendar_name)}",
+    ])
+    
+    async for entry in export_cursor(query):
+        yield ics_event(entry, dtstamp)
+    
+    yield ics_line("END:VCALENDAR")
+
+class ChunkWriter:
+    """Write-only file object collecting bytes until they are drained.
+    
+    It has no seek(), so zipfile writes entries in streaming mode with data
+    descriptors and never needs to rewind the output.
+    """
+    def __init__(self):
+        self._chunks = []
+        self._position = 0
+    
+    def write(self, data: bytes) -> int:
+        self._chunks.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+    
+    def tell(self) -> int:
+        return self._position
+    
+    def flush(self) -> None:
+        pass
+    
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks = []
+        return data
+
+XLSX_STATIC_PARTS = {
+    "[Content_Types].xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Types xmlns="http://schemas.openxmlformats.org/package/2006/content-types">'
+        '<Default Extension="rels" ContentType="application/vnd.openxmlformats-package.relationships+xml"/>'
+        '<Default Extension="xml" ContentType="application/xml"/>'
+        '<Override PartName="/xl/workbook.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet.main+xml"/>'
+        '<Override PartName="/xl/worksheets/sheet1.xml" ContentType="application/vnd.openxmlformats-officedocument.spreadsheetml.worksheet+xml"/>'
+        '</Types>'
+    ),
+    "_rels/.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/officeDocument" Target="xl/workbook.xml"/>'
+        '</Relationships>'
+    ),
+    "xl/workbook.xml": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<workbook xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main" '
+        'xmlns:r="http://schemas.openxmlformats.org/officeDocument/2006/relationships">'
+        '<sheets><sheet name="Abwesenheiten" sheetId="1" r:id="rId1"/></sheets>'
+        '</workbook>'
+    ),
+    "xl/_rels/workbook.xml.rels": (
+        '<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+        '<Relationships xmlns="http://schemas.openxmlformats.org/package/2006/relationships">'
+        '<Relationship Id="rId1" Type="http://schemas.openxmlformats.org/officeDocument/2006/relationships/worksheet" Target="worksheets/sheet1.xml"/>'
+        '</Relationships>'
+    ),
+}
+
+def xlsx_row(values: list) -> str:
+    """Render a worksheet row with inline strings and numeric cells"""
+    cells = []
+    for value in values:
+        if isinstance(value, (int, float)) and not isinstance(value, bool):
+            cells.append(f"<c><v>{value}</v></c>")
+        else:
+            cells.append(f'<c t="inlineStr"><is><t>{xml_escape(str(value))}</t></is></c>')
+    return "<row>" + "".join(cells) + "</row>"
+
+async def stream_xlsx(query: dict) -> AsyncIterator[bytes]:
+    """Stream vacation entries as an XLSX workbook written in chunks"""
+    output = ChunkWriter()
+    
+    with zipfile.ZipFile(output, mode="w", compression=zipfile.ZIP_DEFLATED) as workbook:
+        for name, content in XLSX_STATIC_PARTS.items():
+            workbook.writestr(name, content)
+        
+        with workbook.open("xl/worksheets/sheet1.xml", mode="w") as sheet:
+            sheet.write(
+                b'<?xml version="1.0" encoding="UTF-8" standalone="yes"?>'
+                b'<worksheet xmlns="http://schemas.openxmlformats.org/spreadsheetml/2006/main"><sheetData>'
+            )
+            sheet.write(xlsx_row(EXPORT_COLUMNS).encode("utf-8"))
+            rows = 0
+            
+            async for entry in export_cursor(query):
+                sheet.write(xlsx_row(export_row(entry)).encode("utf-8"))
+                rows += 1
+                if rows % EXPORT_CHUNK_SIZE == 0:
+                    chunk = output.drain()
+                    if chunk:  # The compressor may still be holding the data back
+                        yield chunk
+            
+            sheet.write(b"</sheetData></worksheet>")
+    
+    yield output.drain()
+
+def export_filename(extension: str) -> str:
+    """Build the download filename for an export"""
+    return f"urlaubsplaner-{date.today().isoformat()}.{extension}"
+
+@api_router.get("/export/vacations.csv")
+async def export_vacations_csv(
+    employee_id: Optional[str] = None,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    vacation_type: Optional[VacationType] = None
+):
+    """Export vacation entries as CSV"""
+    query = build_export_query(employee_id, start_date, end_date, vacation_type)
+    return StreamingResponse(
+        stream_csv(query),
+        media_type="text/csv; charset=utf-8",
+        headers={"Content-Disposition": f'attachment; filename="{export_filename("csv")}"'}
+    )
+
+@api_router.get("/export/vacations.ics")
+async def export_vacations_ics(
+    employee_id: Optional[str] = None,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    vacation_type: Optional[VacationType] = None
+):
+    """Export vacation entries as iCalendar"""
+    query = build_export_query(employee_id, start_date, end_date, vacation_type)
+    return StreamingResponse(
+        stream_ics(query, "Urlaubsplaner"),
+        media_type="text/calendar; charset=utf-8",
+        headers={"Content-Disposition": f'attachment; filename="{export_filename("ics")}"'}
+    )
+
+@api_router.get("/export/vacations.xlsx")
+async def export_vacations_xlsx(
+    employee_id: Optional[str] = None,
+    start_date: Optional[date] = None,
+    end_date: Optional[date] = None,
+    vacation_type: Optional[VacationType] = None
+):
+    """Export vacation entries as an Excel workbook"""
+    query = build_export_query(employee_id, start_date, end_date, vacation_type)
+    return StreamingResponse(
+        stream_xlsx(query),
+        media_type="application/vnd.openxmlformats-officedocument.spreadsheetml.sheet",
+        headers={"Content-Disposition": f'attachment; filename="{export_filename("xlsx")}"'}
+    )
+
+def feed_not_modified(request: Request, etag: str, last_modified: datetime) -> bool:
+    """Check the conditional GET headers of a calendar feed request"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # If-None-Match takes precedence over If-Modified-Since and uses weak comparison (RFC 9110)
+        if if_none_match.strip() == "*":
+            return True
+        return any(tag.strip().removeprefix("W/") == etag.removeprefix("W/") for tag in if_none_match.split(","))
+    
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since:
+        try:
+            return last_modified <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+@api_router.get("/export/feeds/{employee_id}.ics")
+async def get_employee_calendar_feed(employee_id: str, request: Request):
+    """Subscribable iCalendar feed with all entries of an employee"""
+    employee = await get_employee_by_id(employee_id)
+    if not employee:
+        raise HTTPException(status_code=404, detail="Employee not found")
+    
+    feed = await db.calendar_feeds.find_one({"employee_id": employee_id})
+    if not feed:
+        feed = await touch_calendar_feed(employee_id)
+    
+    last_modified = feed["updated_date"].replace(tzinfo=timezone.utc)
+    etag = f'"{employee_id}-{feed["version"]}"'
+    headers = {
+        "ETag": etag,
+        "Last-Modified": format_datetime(last_modified, usegmt=True),
+        "Cache-Control": "no-cache"
     }
+    
+    if feed_not_modified(request, etag, last_modified):
+        return Response(status_code=304, headers=headers)
+    
+    return StreamingResponse(
+        stream_ics({"employee_id": employee_id}, f"Abwesenheiten {employee.name}"),
+        media_type="text/calendar; charset=utf-8",
+        headers=headers
+    )
 
 # Health check
 @api_router.get("/health")
@@ -492,6 +1163,24 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+@app.on_event("startup")
+async def load_company_settings():
+    await refresh_settings_snapshot()
+
+@app.on_event("startup")
+async def create_calendar_feed_index():
+    await db.calendar_feeds.create_index("employee_id", unique=True)
+
+@app.on_event("startup")
+async def prepare_employee_balances():
+    await db.employee_balances.create_index([("employee_id", 1), ("year", 1)], unique=True)
+    
+    # Existing deployments have no ledger yet, build it before serving requests
+    if not await db.employee_balances.find_one({}) and await db.vacation_entries.find_one({}):
+        logger.info("employee_balances is empty, rebuilding it from vacation_entries")
+        result = await rebuild_employee_balances()
+        logger.info(f"Built {result['fixed']} employee balances")
+
 @app.on_event("shutdown")
 async def shutdown_db_client():
     client.close()
\ No newline at end of file
@@ -0,0 +1,150 @@
+import itertools
+import sys
+import time
+from pathlib import Path
+from types import SimpleNamespace
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parents[1] / "backend"))
+
+import server  # noqa: E402
+from pymongo import DeleteOne, ReplaceOne, ReturnDocument  # noqa: E402
+
+object_ids = itertools.count(1)
+
+
+def matches(document: dict, query: dict) -> bool:
+    """Evaluate the subset of MongoDB filters used by the server"""
+    for key, condition in query.items():
+        value = document.get(key)
+        if isinstance(condition, dict):
+            for operator, operand in condition.items():
+                if operator == "$lte" and not (value is not None and value <= operand):
+                    return False
+                if operator == "$gte" and not (value is not None and value >= operand):
+                    return False
+                if operator == "$ne" and value == operand:
+                    return False
+        elif value != condition:
+            return False
+    return True
+
+
+class FakeCursor:
+    def __init__(self, documents):
+        self._documents = documents
+
+    def sort(self, *args, **kwargs):
+        return self
+
+    def batch_size(self, size):
+        return self
+
+    async def to_list(self, length):
+        return list(self._documents)
+
+    def __aiter__(self):
+        async def iterate():
+            for document in self._documents:
+                yield document
+        return iterate()
+
+
+class FakeCollection:
+    def __init__(self):
+        self.documents = []
+
+    def find(self, query=None, projection=None):
+        return FakeCursor([dict(doc) for doc in self.documents if matches(doc, query or {})])
+
+    async def find_one(self, query=None, projection=None):
+        for document in self.documents:
+            if matches(document, query or {}):
+                return dict(document)
+        return None
+
+    async def count_documents(self, query):
+        return sum(1 for doc in self.documents if matches(doc, query))
+
+    async def find_one_and_update(self, query, update, upsert=False, return_document=ReturnDocument.BEFORE):
+        for document in self.documents:
+            if matches(document, query):
+                before = dict(document)
+                break
+        else:
+            if not upsert:
+                return None
+            before = None
+            document = {key: value for key, value in query.items() if not isinstance(value, dict)}
+            await self.insert_one(document)
+            document = self.documents[-1]
+        document.update(update.get("$set", {}))
+        for field, amount in update.get("$inc", {}).items():
+            document[field] = document.get(field, 0) + amount
+        return dict(document) if return_document == ReturnDocument.AFTER else before
+
+    def aggregate(self, pipeline):
+        # Only a single {"$group": {"_id": "$field", "count": {"$sum": 1}}} stage is supported
+        field = pipeline[0]["$group"]["_id"].lstrip("$")
+        counts = {}
+        for document in self.documents:
+            counts[document.get(field)] = counts.get(document.get(field), 0) + 1
+        return FakeCursor([{"_id": key, "count": count} for key, count in counts.items()])
+
+    async def insert_one(self, document):
+        document.setdefault("_id", next(object_ids))
+        self.documents.append(dict(document))
+        return SimpleNamespace(inserted_id=document["_id"])
+
+    async def find_one_and_replace(self, query, replacement, return_document=ReturnDocument.BEFORE, upsert=False):
+        for index, document in enumerate(self.documents):
+            if matches(document, query):
+                self.documents[index] = {**replacement, "_id": document["_id"]}
+                return dict(document if return_document == ReturnDocument.BEFORE else self.documents[index])
+        if upsert:
+            await self.insert_one(dict(replacement))
+        return None
+
+    async def find_one_and_delete(self, query):
+        for index, document in enumerate(self.documents):
+            if matches(document, query):
+                return self.documents.pop(index)
+        return None
+
+    async def bulk_write(self, operations, ordered=True):
+        for operation in operations:
+            if isinstance(operation, DeleteOne):
+                self.documents = [doc for doc in self.documents if not matches(doc, operation._filter)]
+            elif isinstance(operation, ReplaceOne):
+                await self.find_one_and_replace(operation._filter, operation._doc, upsert=operation._upsert)
+
+    async def update_one(self, query, update, upsert=False):
+        for document in self.documents:
+            if matches(document, query):
+                for field, amount in update.get("$inc", {}).items():
+                    document[field] = document.get(field, 0) + amount
+                return SimpleNamespace(matched_count=1, modified_count=1)
+        if upsert:
+            document = {key: value for key, value in query.items() if not isinstance(value, dict)}
+            document.update(update.get("$inc", {}))
+            await self.insert_one(document)
+        return SimpleNamespace(matched_count=0, modified_count=0)
+
+
+class FakeDatabase:
+    def __init__(self):
+        self._collections = {}
+
+    def __getattr__(self, name):
+        return self._collections.setdefault(name, FakeCollection())
+
+
+@pytest.fixture
+def fake_db(monkeypatch):
+    database = FakeDatabase()
+    monkeypatch.setattr(server, "db", database)
+    monkeypatch.setattr(
+        server, "settings_snapshot", {"version": 0, "settings": server.CompanySettings(), "loaded": True, "checked_at": time.monotonic()}
+    )
+    return database
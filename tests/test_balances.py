@@ -0,0 +1,241 @@
+import asyncio
+from datetime import date
+
+import pytest
+from fastapi import HTTPException
+
+import server
+
+
+def test_split_business_days_by_year_across_new_year():
+    assert server.split_business_days_by_year(date(2025, 12, 22), date(2026, 1, 9)) == {2025: 8, 2026: 7}
+
+
+def test_split_business_days_by_year_single_year():
+    assert server.split_business_days_by_year(date(2025, 6, 16), date(2025, 6, 20)) == {2025: 5}
+
+
+def test_split_business_days_by_year_skips_years_without_business_days():
+    # 2022-12-31 is a Saturday
+    assert server.split_business_days_by_year(date(2022, 12, 31), date(2023, 1, 2)) == {2023: 1}
+
+
+def balance(fake_db, employee_id, year):
+    return asyncio.run(fake_db.employee_balances.find_one({"employee_id": employee_id, "year": year}))
+
+
+def test_reserve_vacation_days_books_each_year(fake_db):
+    employee = server.Employee(id="emp", name="Anna", vacation_days_total=25)
+
+    asyncio.run(server.reserve_vacation_days(employee, date(2025, 12, 29), date(2026, 1, 2)))
+
+    assert balance(fake_db, "emp", 2025)["vacation_days_used"] == 3
+    assert balance(fake_db, "emp", 2026)["vacation_days_used"] == 2
+    assert balance(fake_db, "emp", 2026)["sick_days"] == 0
+
+
+def test_reserve_vacation_days_rolls_back_when_entitlement_is_exceeded(fake_db):
+    employee = server.Employee(id="emp", name="Anna", vacation_days_total=25)
+    fake_db.employee_balances.documents.append(
+        {"employee_id": "emp", "year": 2025, "vacation_days_used": 20, "sick_days": 0, "special_leave_days": 0}
+    )
+
+    # 2 days in 2024 fit, 8 days in 2025 do not
+    with pytest.raises(HTTPException) as error:
+        asyncio.run(server.reserve_vacation_days(employee, date(2024, 12, 30), date(2025, 1, 10)))
+
+    assert error.value.status_code == 400
+    assert "2025" in error.value.detail
+    assert balance(fake_db, "emp", 2024)["vacation_days_used"] == 0
+    assert balance(fake_db, "emp", 2025)["vacation_days_used"] == 20
+
+
+@pytest.fixture
+def ledger_db(fake_db, monkeypatch):
+    async def touch_calendar_feed(employee_id):
+        return None
+
+    monkeypatch.setattr(server, "touch_calendar_feed", touch_calendar_feed)
+    for index in range(10):
+        fake_db.employees.documents.append(
+            server.Employee(id=f"emp-{index}", name=f"Employee {index}").dict()
+        )
+    return fake_db
+
+
+def book(start, end, employee_id="emp-0", vacation_type="URLAUB"):
+    return server.VacationEntryCreate(
+        employee_id=employee_id, start_date=start, end_date=end, vacation_type=vacation_type
+    )
+
+
+def used(fake_db, employee_id, year, field="vacation_days_used"):
+    return (balance(fake_db, employee_id, year) or {}).get(field, 0)
+
+
+def test_create_entry_books_balance(ledger_db):
+    asyncio.run(server.create_vacation_entry(book(date(2025, 12, 29), date(2026, 1, 2))))
+
+    assert used(ledger_db, "emp-0", 2025) == 3
+    assert used(ledger_db, "emp-0", 2026) == 2
+
+
+def test_create_entry_rolls_back_balance_when_insert_fails(ledger_db, monkeypatch):
+    async def insert_one(document):
+        raise RuntimeError("write failed")
+
+    monkeypatch.setattr(ledger_db.vacation_entries, "insert_one", insert_one)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(server.create_vacation_entry(book(date(2025, 6, 16), date(2025, 6, 20))))
+
+    assert used(ledger_db, "emp-0", 2025) == 0
+
+
+def test_update_entry_moves_days_to_other_employee_and_type(ledger_db):
+    entry = asyncio.run(server.create_vacation_entry(book(date(2025, 6, 16), date(2025, 6, 20))))
+
+    asyncio.run(server.update_vacation_entry(
+        entry.id, book(date(2025, 6, 16), date(2025, 6, 18), employee_id="emp-1", vacation_type="KRANKHEIT")
+    ))
+
+    assert used(ledger_db, "emp-0", 2025) == 0
+    assert used(ledger_db, "emp-1", 2025) == 0
+    assert used(ledger_db, "emp-1", 2025, "sick_days") == 3
+
+
+def test_update_entry_restores_old_booking_when_entitlement_is_exceeded(ledger_db):
+    entry = asyncio.run(server.create_vacation_entry(book(date(2025, 6, 16), date(2025, 6, 20))))
+
+    with pytest.raises(server.HTTPException) as error:
+        asyncio.run(server.update_vacation_entry(entry.id, book(date(2025, 6, 2), date(2025, 7, 18))))
+
+    assert error.value.status_code == 400
+    assert used(ledger_db, "emp-0", 2025) == 5
+
+
+def test_update_entry_rolls_back_when_replace_fails(ledger_db, monkeypatch):
+    entry = asyncio.run(server.create_vacation_entry(book(date(2025, 6, 16), date(2025, 6, 20))))
+
+    async def find_one_and_replace(*args, **kwargs):
+        raise RuntimeError("write failed")
+
+    monkeypatch.setattr(ledger_db.vacation_entries, "find_one_and_replace", find_one_and_replace)
+
+    with pytest.raises(RuntimeError):
+        asyncio.run(server.update_vacation_entry(
+            entry.id, book(date(2025, 6, 16), date(2025, 6, 17), vacation_type="SONDERURLAUB")
+        ))
+
+    assert used(ledger_db, "emp-0", 2025) == 5
+    assert used(ledger_db, "emp-0", 2025, "special_leave_days") == 0
+
+
+def test_update_racing_delete_leaves_no_days_booked(ledger_db, monkeypatch):
+    entry = asyncio.run(server.create_vacation_entry(book(date(2025, 6, 16), date(2025, 6, 20))))
+    original_replace = ledger_db.vacation_entries.find_one_and_replace
+
+    async def find_one_and_replace(*args, **kwargs):
+        # The entry is deleted between the update's read and its write
+        await server.delete_vacation_entry(entry.id)
+        return await original_replace(*args, **kwargs)
+
+    monkeypatch.setattr(ledger_db.vacation_entries, "find_one_and_replace", find_one_and_replace)
+
+    with pytest.raises(server.HTTPException) as error:
+        asyncio.run(server.update_vacation_entry(entry.id, book(date(2025, 6, 16), date(2025, 6, 17))))
+
+    assert error.value.status_code == 404
+    assert used(ledger_db, "emp-0", 2025) == 0
+
+
+def test_concurrent_updates_remove_old_days_once(ledger_db, monkeypatch):
+    entry = asyncio.run(server.create_vacation_entry(book(date(2025, 6, 16), date(2025, 6, 20))))
+    original_replace = ledger_db.vacation_entries.find_one_and_replace
+
+    async def find_one_and_replace(*args, **kwargs):
+        # Another update replaces the entry after this update read it
+        monkeypatch.setattr(ledger_db.vacation_entries, "find_one_and_replace", original_replace)
+        await server.update_vacation_entry(entry.id, book(date(2025, 6, 16), date(2025, 6, 18)))
+        return await original_replace(*args, **kwargs)
+
+    monkeypatch.setattr(ledger_db.vacation_entries, "find_one_and_replace", find_one_and_replace)
+
+    asyncio.run(server.update_vacation_entry(entry.id, book(date(2025, 6, 16), date(2025, 6, 16))))
+
+    assert used(ledger_db, "emp-0", 2025) == 1
+
+
+def test_delete_entry_twice_removes_days_once(ledger_db):
+    asyncio.run(server.create_vacation_entry(book(date(2025, 6, 2), date(2025, 6, 6))))
+    entry = asyncio.run(server.create_vacation_entry(book(date(2025, 6, 16), date(2025, 6, 20))))
+
+    asyncio.run(server.delete_vacation_entry(entry.id))
+    with pytest.raises(server.HTTPException) as error:
+        asyncio.run(server.delete_vacation_entry(entry.id))
+
+    assert error.value.status_code == 404
+    assert used(ledger_db, "emp-0", 2025) == 5
+
+
+def test_sick_days_match_summary_across_year_boundary(ledger_db):
+    asyncio.run(server.create_vacation_entry(book(date(2025, 12, 29), date(2026, 1, 2), vacation_type="KRANKHEIT")))
+
+    sick_days = asyncio.run(server.get_employee_sick_days("emp-0", year=2026))
+    summary = asyncio.run(server.get_employee_vacation_summary("emp-0", year=2026))
+
+    assert sick_days["sick_days"] == summary["sick_days"] == 2
+    assert sick_days["sick_entries_count"] == 1
+
+
+def add_entry(fake_db, employee_id, start, end, vacation_type="URLAUB"):
+    fake_db.vacation_entries.documents.append({
+        "id": f"{employee_id}-{start}",
+        "employee_id": employee_id,
+        "start_date": start,
+        "end_date": end,
+        "vacation_type": vacation_type
+    })
+
+
+def add_balance(fake_db, employee_id, year, vacation_days_used=0, sick_days=0):
+    fake_db.employee_balances.documents.append({
+        "_id": f"{employee_id}-{year}",
+        "employee_id": employee_id,
+        "year": year,
+        "vacation_days_used": vacation_days_used,
+        "sick_days": sick_days,
+        "special_leave_days": 0
+    })
+
+
+def test_rebuild_dry_run_reports_without_writing(fake_db):
+    add_entry(fake_db, "emp", "2025-06-16", "2025-06-20")
+    add_balance(fake_db, "emp", 2025, vacation_days_used=3)
+    add_balance(fake_db, "gone", 2025, sick_days=2)
+    before = [dict(doc) for doc in fake_db.employee_balances.documents]
+
+    result = asyncio.run(server.rebuild_employee_balances(dry_run=True))
+
+    assert result["fixed"] == 0
+    reported = {(mismatch["employee_id"], mismatch["year"]): mismatch for mismatch in result["mismatches"]}
+    assert reported[("emp", 2025)]["stored"]["vacation_days_used"] == 3
+    assert reported[("emp", 2025)]["expected"]["vacation_days_used"] == 5
+    assert reported[("gone", 2025)]["expected"] is None
+    assert fake_db.employee_balances.documents == before
+
+
+def test_rebuild_fixes_drift_and_removes_orphans(fake_db):
+    add_entry(fake_db, "emp", "2025-12-29", "2026-01-02")
+    add_entry(fake_db, "emp", "2025-03-03", "2025-03-04", vacation_type="KRANKHEIT")
+    add_balance(fake_db, "emp", 2025, vacation_days_used=9)
+    add_balance(fake_db, "gone", 2025)
+
+    result = asyncio.run(server.rebuild_employee_balances())
+
+    assert result["fixed"] == 2  # emp 2025 was wrong, emp 2026 was missing
+    assert used(fake_db, "emp", 2025) == 3
+    assert used(fake_db, "emp", 2025, "sick_days") == 2
+    assert used(fake_db, "emp", 2026) == 2
+    assert balance(fake_db, "gone", 2025) is None
+    assert asyncio.run(server.rebuild_employee_balances(dry_run=True))["mismatches"] == []
@@ -0,0 +1,83 @@
+import asyncio
+import time
+from datetime import date
+
+import server
+
+
+def add_employees(fake_db, count, team=""):
+    ids = [f"{team or 'emp'}-{index}" for index in range(count)]
+    fake_db.employees.documents.extend({"id": employee_id, "team": team} for employee_id in ids)
+    return ids
+
+
+def add_vacation(fake_db, employee_id, start, end, entry_id=None, vacation_type="URLAUB"):
+    fake_db.vacation_entries.documents.append({
+        "id": entry_id or f"{employee_id}-{start}",
+        "employee_id": employee_id,
+        "start_date": start,
+        "end_date": end,
+        "vacation_type": vacation_type
+    })
+
+
+def test_find_peak_day_skips_weekends_and_counts_new_vacation():
+    # 2025-06-16 is a Monday, the weekend values must be ignored
+    count, day = server.find_peak_day(date(2025, 6, 16), [0, 2, 1, 0, 0, 5, 5])
+    assert count == 3
+    assert day == date(2025, 6, 17)
+
+
+def test_company_limit_counts_overlaps_per_day(fake_db):
+    ids = add_employees(fake_db, 10)  # 30% of 10 -> 3 people
+    add_vacation(fake_db, ids[0], "2025-06-10", "2025-06-17")
+    add_vacation(fake_db, ids[1], "2025-06-17", "2025-06-30")
+    add_vacation(fake_db, ids[2], "2025-06-19", "2025-06-19")
+    add_vacation(fake_db, ids[3], "2025-06-17", "2025-06-17", vacation_type="KRANKHEIT")
+
+    result = asyncio.run(server.check_concurrent_vacations(date(2025, 6, 16), date(2025, 6, 20)))
+
+    assert result["is_valid"]
+    assert result["max_concurrent_count"] == 3
+    assert result["max_concurrent_day"] == date(2025, 6, 17)
+    assert result["max_allowed"] == 3
+    assert result["team_check"] is None
+
+    add_vacation(fake_db, ids[4], "2025-06-17", "2025-06-18")
+    result = asyncio.run(server.check_concurrent_vacations(date(2025, 6, 16), date(2025, 6, 20)))
+    assert not result["is_valid"]
+    assert result["max_concurrent_count"] == 4
+
+
+def test_excluded_entry_is_not_counted(fake_db):
+    ids = add_employees(fake_db, 3)  # Limit is 1 person
+    add_vacation(fake_db, ids[0], "2025-06-16", "2025-06-20", entry_id="existing")
+
+    result = asyncio.run(
+        server.check_concurrent_vacations(date(2025, 6, 16), date(2025, 6, 20), exclude_entry_id="existing")
+    )
+
+    assert result["is_valid"]
+    assert result["max_concurrent_count"] == 1
+
+
+def test_team_limit_only_counts_team_members(fake_db, monkeypatch):
+    settings = server.CompanySettings(team_limits={"IT": server.TeamLimit(max_concurrent_fixed=1)})
+    monkeypatch.setattr(server, "settings_snapshot", {"version": 1, "settings": settings, "loaded": True, "checked_at": time.monotonic()})
+    team_ids = add_employees(fake_db, 2, team="IT")
+    other_ids = add_employees(fake_db, 8)
+    add_vacation(fake_db, other_ids[0], "2025-06-16", "2025-06-20")
+
+    result = asyncio.run(server.check_concurrent_vacations(date(2025, 6, 16), date(2025, 6, 20), team="IT"))
+    assert result["is_valid"]
+    assert result["team_check"]["max_concurrent_count"] == 1
+    assert result["team_check"]["total_employees"] == 2
+
+    add_vacation(fake_db, team_ids[0], "2025-06-18", "2025-06-18")
+    result = asyncio.run(server.check_concurrent_vacations(date(2025, 6, 16), date(2025, 6, 20), team="IT"))
+
+    assert not result["is_valid"]
+    assert result["max_concurrent_count"] == 3  # Company limit of 3 is still kept
+    assert result["team_check"]["is_valid"] is False
+    assert result["team_check"]["max_concurrent_count"] == 2
+    assert result["team_check"]["max_concurrent_day"] == date(2025, 6, 18)
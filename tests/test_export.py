@@ -0,0 +1,73 @@
+from datetime import datetime, timezone
+
+from starlette.requests import Request
+
+import server
+
+
+def make_request(**headers):
+    raw_headers = [(name.replace("_", "-").encode(), value.encode()) for name, value in headers.items()]
+    return Request({"type": "http", "method": "GET", "headers": raw_headers})
+
+
+def unfold(text):
+    return text.replace("\r\n ", "")
+
+
+def test_ics_escape():
+    assert server.ics_escape("a,b;c\\d\nnext") == "a\\,b\\;c\\\\d\\nnext"
+    assert server.ics_escape("line\r\nbreak") == "line\\nbreak"
+
+
+def test_ics_line_short_line_is_not_folded():
+    assert server.ics_line("SUMMARY:Urlaub") == "SUMMARY:Urlaub\r\n"
+
+
+def test_ics_line_folds_long_lines_to_75_octets():
+    line = "DESCRIPTION:" + "x" * 200
+    folded = server.ics_line(line)
+
+    assert folded.endswith("\r\n")
+    assert all(len(part.encode("utf-8")) <= 75 for part in folded[:-2].split("\r\n"))
+    assert unfold(folded[:-2]) == line
+
+
+def test_ics_line_does_not_split_multibyte_characters():
+    line = "DESCRIPTION:" + "Ä" * 100
+    folded = server.ics_line(line)
+
+    assert all(len(part.encode("utf-8")) <= 75 for part in folded[:-2].split("\r\n"))
+    assert unfold(folded[:-2]) == line
+
+
+LAST_MODIFIED = datetime(2025, 6, 16, 12, 0, 0, tzinfo=timezone.utc)
+ETAG = '"emp-2"'
+
+
+def test_feed_without_conditional_headers_is_modified():
+    assert not server.feed_not_modified(make_request(), ETAG, LAST_MODIFIED)
+
+
+def test_feed_matching_etag_is_not_modified():
+    assert server.feed_not_modified(make_request(if_none_match='"emp-1", "emp-2"'), ETAG, LAST_MODIFIED)
+    assert server.feed_not_modified(make_request(if_none_match="*"), ETAG, LAST_MODIFIED)
+
+
+def test_feed_weak_etag_matches():
+    assert server.feed_not_modified(make_request(if_none_match='W/"emp-2"'), ETAG, LAST_MODIFIED)
+    assert not server.feed_not_modified(make_request(if_none_match='W/"emp-1"'), ETAG, LAST_MODIFIED)
+
+
+def test_feed_etag_takes_precedence_over_if_modified_since():
+    request = make_request(if_none_match='"emp-1"', if_modified_since="Mon, 16 Jun 2025 13:00:00 GMT")
+    assert not server.feed_not_modified(request, ETAG, LAST_MODIFIED)
+
+
+def test_feed_if_modified_since():
+    assert server.feed_not_modified(
+        make_request(if_modified_since="Mon, 16 Jun 2025 12:00:00 GMT"), ETAG, LAST_MODIFIED
+    )
+    assert not server.feed_not_modified(
+        make_request(if_modified_since="Mon, 16 Jun 2025 11:59:59 GMT"), ETAG, LAST_MODIFIED
+    )
+    assert not server.feed_not_modified(make_request(if_modified_since="not a date"), ETAG, LAST_MODIFIED)
@@ -0,0 +1,68 @@
+import asyncio
+
+import server
+
+
+def stored_settings(fake_db, version, **settings):
+    fake_db.settings.documents.append({"id": server.SETTINGS_DOCUMENT_ID, "version": version, **settings})
+
+
+def test_store_settings_snapshot_ignores_older_versions(fake_db):
+    server.store_settings_snapshot({"version": 3, "max_concurrent_percentage": 40})
+    server.store_settings_snapshot({"version": 2, "max_concurrent_percentage": 10})
+
+    assert server.settings_snapshot["version"] == 3
+    assert server.settings_snapshot["settings"].max_concurrent_percentage == 40
+
+
+def test_get_settings_loads_snapshot_on_first_use(fake_db):
+    server.settings_snapshot["loaded"] = False
+    stored_settings(fake_db, 2, max_concurrent_fixed=4)
+
+    settings = asyncio.run(server.get_settings())
+
+    assert settings.max_concurrent_fixed == 4
+    assert server.settings_snapshot["version"] == 2
+
+
+def test_get_settings_serves_snapshot_within_check_interval(fake_db):
+    stored_settings(fake_db, 5, max_concurrent_fixed=4)
+
+    settings = asyncio.run(server.get_settings())
+
+    assert settings.max_concurrent_fixed is None
+    assert server.settings_snapshot["version"] == 0
+
+
+def test_get_settings_reloads_newer_version_from_other_worker(fake_db, monkeypatch):
+    monkeypatch.setattr(server, "SETTINGS_VERSION_CHECK_SECONDS", 0)
+    stored_settings(fake_db, 5, max_concurrent_fixed=4, team_limits={"IT": {"max_concurrent_fixed": 1}})
+
+    settings = asyncio.run(server.get_settings())
+
+    assert settings.max_concurrent_fixed == 4
+    assert settings.team_limits["IT"].max_concurrent_fixed == 1
+    assert server.settings_snapshot["version"] == 5
+
+
+def test_update_company_settings_bumps_version_and_snapshot(fake_db):
+    fake_db.employees.documents.extend([
+        {"id": "a", "team": "IT"},
+        {"id": "b", "team": "IT"},
+        {"id": "c", "team": ""}
+    ])
+    update = server.CompanySettings(
+        max_concurrent_percentage=50, team_limits={"IT": server.TeamLimit(max_concurrent_fixed=1)}
+    )
+
+    first = asyncio.run(server.update_company_settings(update))
+    second = asyncio.run(server.update_company_settings(update))
+
+    assert first["version"] == 1
+    assert second["version"] == 2
+    assert second["max_concurrent_calculated"] == 1  # 50% of 3 employees
+    assert second["team_limits"]["IT"]["total_employees"] == 2
+    assert second["team_limits"]["IT"]["max_concurrent_calculated"] == 1
+    assert server.settings_snapshot["version"] == 2
+    assert server.settings_snapshot["settings"].max_concurrent_percentage == 50
+    assert len(fake_db.settings.documents) == 1